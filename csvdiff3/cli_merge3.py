@@ -3,6 +3,7 @@
 import click
 import sys
 import os
+import stat
 import shutil
 import tempfile
 
@@ -59,8 +60,39 @@ def cli_merge3(filename_lca, filename_a, filename_b,
 
     if output_file:
 
-        with tempfile.NamedTemporaryFile("wt") as temp_output:
-            try:
+        # Write the output to a temporary file, and only put it in
+        # place once the merge has finished.
+        #
+        # If the output is a plain file (or does not exist yet), create
+        # the temporary file alongside it and rename it into place: the
+        # rename is atomic and avoids copying the whole output a second
+        # time.  If the output file is a symlink, replace the file it
+        # points to rather than the link itself.
+        #
+        # Anything else --- a device, a file with other hard links, or
+        # a file owned by somebody else --- must be written through
+        # rather than replaced, so copy the output over it instead.
+
+        output_file = os.path.realpath(output_file)
+        try:
+            output_stat = os.stat(output_file)
+        except FileNotFoundError:
+            output_stat = None
+
+        replace = (output_stat is None or
+                   (stat.S_ISREG(output_stat.st_mode) and
+                    output_stat.st_nlink == 1 and
+                    output_stat.st_uid == os.geteuid()))
+
+        temp_output = tempfile.NamedTemporaryFile("wt",
+                                                  dir = (os.path.dirname(output_file)
+                                                         if replace else None),
+                                                  prefix = ".csvmerge3-",
+                                                  delete = False)
+        temp_name = temp_output.name
+
+        try:
+            with temp_output:
                 rc = merge3(filename_lca, filename_a, filename_b, key,
                             output = temp_output,
                             debug = debug,
@@ -70,13 +102,31 @@ def cli_merge3(filename_lca, filename_a, filename_b,
                             reformat_all = reformat_all,
                             output_driver_class = Merge3OutputDriver,
                             filename_LCA = filename_lca, filename_A = filename_a, filename_B = filename_b)
-            except CSVKeyError as e:
-                print(f"{os.path.basename(sys.argv[0])}: Error: {e.message}", file=sys.stdout)
-                sys.exit(1)
 
-            temp_name = temp_output.name
-            temp_output.flush()
-            shutil.copyfile(temp_name, output_file)
+            if replace:
+                # The temporary file is created private to the user; if
+                # we are replacing an existing file, keep that file's
+                # permissions, otherwise give it the usual permissions
+                # for a new file.
+
+                if output_stat:
+                    shutil.copymode(output_file, temp_name)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(temp_name, 0o666 & ~umask)
+                os.replace(temp_name, output_file)
+            else:
+                shutil.copyfile(temp_name, output_file)
+
+        except CSVKeyError as e:
+            print(f"{os.path.basename(sys.argv[0])}: Error: {e.message}", file=sys.stdout)
+            sys.exit(1)
+
+        finally:
+            # Once renamed into place, there is nothing left to clean up
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
 
     else:
 
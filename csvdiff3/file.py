@@ -10,9 +10,9 @@
 
 import csv
 import logging
-import shutil
-from orderedmultidict import omdict
-from collections import UserString
+import sys
+from collections import deque, defaultdict
+from itertools import islice
 from .tools.options import MergeFailedError
 
 # Define a custom string type that always evaluates to True when cast
@@ -41,16 +41,30 @@ from .tools.options import MergeFailedError
 # True in such situations; False will only be returned if the Key is
 # None, ie. it is genuinely missing and we have no matching line in
 # the given file.
+#
+# Key subclasses the builtin str rather than UserString, so that
+# constructing, hashing and comparing keys all stay in C.
+
+class Key(str):
+    __slots__ = ()
 
-class Key(UserString):
     def __bool__(self):
         return True
 
+_EMPTY_KEY = Key('')
+
 class Line:
     """
     Holds an individual line from a CSV file.
     """
 
+    # We create one Line for every line of every input file, so avoid
+    # the cost of a per-instance __dict__.
+
+    __slots__ = ("text", "row", "linenr", "key",
+                 "is_consumed", "LCA_backlog_match",
+                 "backlog_match_in_A", "backlog_match_in_B")
+
     def __init__(self, text, row, linenr):
         self.text = text
         self.row = row
@@ -58,6 +72,15 @@ class Line:
         self.is_consumed = False
         self.LCA_backlog_match = None
 
+        # For LCA lines pushed to the backlog, the lines in A and B
+        # that they were matched against at the time (see merge3_next())
+        self.backlog_match_in_A = None
+        self.backlog_match_in_B = None
+
+        # The line's primary key value, filled in once the file's key
+        # column is known (see CSVFile.setup_key())
+        self.key = None
+
     def __format__(self, format):
         return str(self.row) + f" @ {self.linenr}"
 
@@ -66,16 +89,19 @@ class Line:
         return self.linenr - line.linenr
 
     def get_field(self, index):
-        try:
-            return Key(self.row[index])
-        except IndexError:
-            return Key('')
+        row = self.row
+        if index < len(row):
+            return Key(row[index])
+        return _EMPTY_KEY
 
     # For debugging we sometimes want to output a linenr even if we're
-    # not sure we actually have a line
+    # not sure we actually have a line.
+    #
+    # (This can't share the name of the linenr attribute, as __slots__
+    # does not allow a class attribute of the same name.)
 
     @staticmethod
-    def linenr(line):
+    def debug_linenr(line):
         if not line:
             return "n/a"
         return line.linenr
@@ -89,52 +115,62 @@ class Line:
 # just by looking up the header line contents as usual.
 
 class EmptyLine(Line):
+    __slots__ = ()
+
     def __init__(self):
         self.text = None
         self.row = []
         self.linenr = 1
+        self.key = None
 
-class FileReader:
+class CSVLineReader:
     """
-    File reader which also retains the original, unmodified contents of
+    CSV reader which also returns the original, unmodified contents of
     each line read.
 
-    Allows the file to be passed to an existing iterator while still
-    allowing the individual lines to be recalled separately.
+    Iterator returns a tuple (string, list); read_all() returns the
+    same tuples for the whole file as a list.
     """
 
-    def __init__(self, stream):
+    def __init__(self, stream, **args):
         self.stream = stream
-        self.lastlines = ""
 
-    def __iter__(self):
-        while True:
-            line = self.stream.readline()
-            if line == "":
-                break
-            self.lastlines += line
-            yield line
-
-    def get_last_lines(self):
-        lines = self.lastlines
-        self.lastlines = ""
-        return lines
+        # Read the whole stream up-front as a list of physical lines.
+        # csv.reader can then consume the list directly, and its
+        # line_num tells us how many physical lines each record
+        # spanned, so we can recover the verbatim text by slicing
+        # rather than capturing it line by line as we go.
+        #
+        # We only rely on readline() here, so that line splitting
+        # follows the stream's own newline handling and any file-like
+        # object that supports readline() can be used as input.
 
-class CSVLineReader:
-    """
-    CSV reader which also returns the original, unmodified contents of
-    each line read.
+        self.lines = list(iter(stream.readline, ""))
 
-    Iterator returns a tuple (string, list)
-    """
+        self.reader = csv.reader(self.lines, **args)
 
-    def __init__(self, stream, **args):
-        self.file = FileReader(stream)
-        self.reader = csv.reader(self.file, **args)
+    def read_all(self):
+        """
+        Parse all remaining records in a single pass, returning a list
+        of (text, row) tuples.
+        """
+        lines = self.lines
+        reader = self.reader
+        records = []
+        start = 0
+        for row in reader:
+            end = reader.line_num
+            # Most records are a single physical line, which needs
+            # no joining.
+            if end == start + 1:
+                records.append((lines[start], row))
+            else:
+                records.append(("".join(lines[start:end]), row))
+            start = end
+        return records
 
     def __iter__(self):
-        for row in self.reader:
-            yield (self.file.get_last_lines(), row)
+        return iter(self.read_all())
 
 class CSVHeaderFile:
     """
@@ -144,29 +180,39 @@ class CSVHeaderFile:
 
     def __init__(self, stream, **args):
         self.reader = CSVLineReader(stream, **args)
-        self.iterator = iter(self.reader)
+        self.records = self.reader.read_all()
         self.empty = False
 
-        try:
-            text,row = next(self.iterator)
-        except StopIteration:
-            # If an input file is entirely empty --- we fail to
-            # iterate on the next() to grab the very first line ---
-            # then store a blank header line and mark the file as
-            # empty, but do not fail.  We will handle empty files
-            # later (eg. for diffing the creation or deletion of a
-            # file.)
+        if self.records:
+            text,row = self.records[0]
+        else:
+            # If an input file is entirely empty --- there is not
+            # even a first line to read --- then store a blank header
+            # line and mark the file as empty, but do not fail.  We
+            # will handle empty files later (eg. for diffing the
+            # creation or deletion of a file.)
             self.empty = True
             text=None
             row=[]
 
         self.header = Line(text,row,1)
 
+    def read_lines(self):
+        """
+        Return a list of Line objects for every line after the header.
+
+        Like reading the stream itself, this can only be done once:
+        the parsed records are dropped once their Lines are built, so
+        that we do not keep a second copy of the file alive, and any
+        later call returns no lines.
+        """
+        records = self.records
+        self.records = []
+        return [Line(text, row, linenr)
+                for linenr, (text, row) in enumerate(islice(records, 1, None), 2)]
+
     def __iter__(self):
-        linenr = 2
-        for line,row in self.iterator:
-            yield Line(line, row, linenr)
-            linenr += 1
+        return iter(self.read_lines())
 
 class CSVKeyError(MergeFailedError):
     def __init__(self, message, *args):
@@ -184,6 +230,24 @@ class CSVFile:
         self.reader = CSVHeaderFile(stream, **args)
 
         self.header = self.reader.header
+
+        # Column names are compared repeatedly while merging headers
+        # and looking up keys, and usually repeat across the files
+        # being merged; intern them so they share storage and compare
+        # by identity.
+
+        self.header.row = [sys.intern(name) for name in self.header.row]
+
+        # Map each column name to its (first) column number, for
+        # constant-time key lookups.  Walk the header backwards so
+        # that a duplicated name maps to its first column, as
+        # list.index() would.
+
+        self.column_index = {name: column
+                             for column, name
+                             in reversed(list(enumerate(self.header.row)))}
+
+        self.raw_lines = self.reader.reader.lines
         self.key = key
         self.lines = [self.header]
         self.lines_by_key = {}
@@ -195,8 +259,7 @@ class CSVFile:
         # searches ahead in the file only far enough to resolve
         # reordered lines with a given window.
 
-        for count, line in enumerate(self.reader, 2):
-            self.lines.append(line)
+        self.lines.extend(self.reader.read_lines())
 
         self.last_line = len(self.lines)
 
@@ -207,7 +270,7 @@ class CSVFile:
 
         self.key = key
 
-        if not key in self.header.row:
+        if not key in self.column_index:
             # One special case: a completely empty file is not
             # expected to have a header row at all.  We won't find the
             # key in the header, but we won't be looking up lines by
@@ -223,22 +286,46 @@ class CSVFile:
 
             raise CSVKeyError(f"""key "{key}" not found in file {self.filename}""")
 
-        self.key_index = self.header.row.index(next(x for x in self.header.row
-                                                    if x == key))
+        self.key_index = key_index = self.column_index[key]
+
+        # Build the lookup with a defaultdict so that each line costs a
+        # single hash probe, but store it as a plain dict: lookups of
+        # keys that are not present must still raise KeyError rather
+        # than silently adding an empty entry.
+
+        lines_by_key = defaultdict(deque)
+
+        intern = sys.intern
 
         for line in self.lines:
+            # Intern key values too: the same keys appear in each of
+            # the files being merged, and are hashed and compared on
+            # every lookup.
+            #
             # If there is a short line which does not include a field
             # for the primary key column, it just gets assigned a
             # blank key
-            key = line.get_field(self.key_index)
-            if key in self.lines_by_key:
-                self.lines_by_key[key].append(line)
+
+            row = line.row
+            if key_index < len(row):
+                value = row[key_index] = intern(row[key_index])
             else:
-                self.lines_by_key[key] = [line]
+                value = ""
+
+            # The Line gets a Key, so that even a blank key tests as
+            # True; but index lines_by_key on the plain string, which
+            # lets the dict use its fast path for exact str keys.
+            # Key compares and hashes the same as str, so lookups by
+            # Key still work.
+
+            line.key = Key(value)
+            lines_by_key[value].append(line)
+
+        self.lines_by_key = dict(lines_by_key)
 
     def __iter__(self):
-        for line in self.lines[1:]:
-            yield line
+        # Skip the header without copying the rest of the lines list
+        return islice(self.lines, 1, None)
 
     def __getitem__(self, line):
         # List indices start at 0, but by normal convention we assume
@@ -262,12 +349,14 @@ class CSVFile:
     def dump(self, id, prefix):
         """Dump a CSVFile's contents to a safe dump location for later debugging."""
 
+        # We still hold the full original text of the file, so write
+        # that out directly rather than re-reading the input stream
+        # (which may not be seekable, eg. if it is a pipe.)
+
         filename = prefix + "-" + id + ".dump"
-        stream = self.reader.reader.file.stream
         logging.debug(f"Dumping file {id} to {filename}")
-        stream.seek(0)
         with open(filename, "wt") as outfile:
-            shutil.copyfileobj(stream, outfile)
+            outfile.writelines(self.raw_lines)
 
 class Cursor:
     """
@@ -278,6 +367,8 @@ class Cursor:
     to the current position.
     """
 
+    __slots__ = ("file", "linenr", "backlog")
+
     def __init__(self, file):
         self.file = file
 
@@ -286,8 +377,13 @@ class Cursor:
         self.linenr = 2
 
         # Maintain a backlog of Lines that we know we will need later
-        # on from some file
-        self.backlog = omdict()
+        # on from some file.
+        #
+        # The backlog maps each key to a deque of Lines with that key,
+        # in the order they were pushed; keys are removed entirely
+        # once their last Line is consumed, so an empty backlog is an
+        # empty dict.
+        self.backlog = {}
 
     def __getitem__(self, offset):
         """
@@ -317,20 +413,30 @@ class Cursor:
         Advance the current line position to the next line in a file
         """
 
+        # This runs for every line of every file, so work on local
+        # copies of the file state and index the lines list directly
+        # rather than going through self[] and EOF().
+
+        file = self.file
+        lines = file.lines
+        last_line = file.last_line
+        linenr = self.linenr
+
         # First remove the line from the per-key line lookup
-        line = self[0]
+        line = lines[linenr-1]
         if not line.is_consumed:
-            key = self.current_key()
-            found_line = self.file.lines_by_key[key].pop(0)
-            assert line == found_line
+            found_line = file.lines_by_key[line.key].popleft()
+            assert line is found_line
 
-        if self.linenr <= self.file.last_line:
-            self.linenr += 1
+        if linenr <= last_line:
+            linenr += 1
 
         # Skip over any lines which have already been processed
 
-        while (not self.EOF()) and self[0].is_consumed:
-            self.linenr += 1
+        while linenr <= last_line and lines[linenr-1].is_consumed:
+            linenr += 1
+
+        self.linenr = linenr
 
     def current_key(self):
         """
@@ -339,12 +445,15 @@ class Cursor:
         Returns None if we are at EOF.
         """
 
-        if self.EOF():
+        file = self.file
+        linenr = self.linenr
+
+        if file.reader.empty or linenr > file.last_line:
             return None
 
-        # If there is a short line which does not include a field for
-        # the primary key column, it just gets assigned a blank key
-        return self.getline(0).get_field(self.file.key_index)
+        # The key was cached on each line when the file's key was set
+        # up, so we don't need to extract it from the row again.
+        return file.lines[linenr-1].key
 
     def EOF(self):
         return self.file.reader.empty or self.linenr > self.file.last_line
@@ -359,14 +468,32 @@ class Cursor:
 
         Automatically advances to the next line position.
         """
-        key = self.current_key()
+        line = self.file.lines[self.linenr-1]
         # We need to be able to handle multiple instances of the same
         # key in the backlog, for the special case where multiple
         # lines with the same key exist, and all of those lines are
         # being reordered in the output
-        self.backlog.add(key, self.getline(0))
+        self.backlog.setdefault(line.key, deque()).append(line)
         self.advance()
 
+    def backlog_first(self, key):
+        """
+        Return the first (oldest) Line in the backlog for a given key.
+        """
+        return self.backlog[key][0]
+
+    def backlog_pop_first(self, key):
+        """
+        Remove and return the first Line in the backlog for a given
+        key, dropping the key from the backlog once it has no more
+        Lines.
+        """
+        lines = self.backlog[key]
+        line = lines.popleft()
+        if not lines:
+            del self.backlog[key]
+        return line
+
     def find_next_match(self, key):
         """
         Find the next Line matching a given key, to help find
@@ -376,11 +503,12 @@ class Cursor:
         match.
         """
 
-        assert key != None
+        assert key is not None
 
-        if not key in self.file.lines_by_key:
-            return None
-        lines = self.file.lines_by_key[key]
+        # A single dict probe covers both the missing-key and the
+        # no-lines-left cases.
+
+        lines = self.file.lines_by_key.get(key)
         if not lines:
             return None
 
@@ -427,8 +555,8 @@ class Cursor:
         # by key and is the exact correct line.
 
         if key in self.backlog:
-            if self.backlog[key] == line:
-                self.backlog.popvalue(key, last=False)
+            if self.backlog_first(key) is line:
+                self.backlog_pop_first(key)
                 return
 
         # It's not in the backlog so it must be either the current
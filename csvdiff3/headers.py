@@ -7,6 +7,7 @@
 
 from .file import Line
 import logging
+import sys
 
 class HeaderMap:
     """
@@ -18,6 +19,10 @@ class HeaderMap:
     given input file.
     """
 
+    # A map is built for every output column, so keep the instances
+    # small.
+    __slots__ = ("name", "LCA_column", "A_column", "B_column")
+
     def __init__(self, name,
                  LCA_column = None,
                  A_column = None,
@@ -29,11 +34,10 @@ class HeaderMap:
 
     @staticmethod
     def from_state(state, column):
-        LCA_column = state.find_column(state.orig_LCA, column)
-        A_column = state.find_column(state.orig_A, column)
-        B_column = state.find_column(state.orig_B, column)
-
-        return HeaderMap(column, LCA_column, A_column, B_column)
+        return HeaderMap(column,
+                         state.LCA_index.get(column),
+                         state.A_index.get(column),
+                         state.B_index.get(column))
 
 class Headers:
     class __State:
@@ -41,32 +45,82 @@ class Headers:
         """
         Internal processing state for the merging of headers
         """
+
+        # The state's attributes are read on every pass of the merge
+        # loop, so use fixed slots rather than an instance dict.
+        __slots__ = ("LCA", "A", "B",
+                     "LCA_pos", "A_pos", "B_pos",
+                     "consumed",
+                     "head_LCA", "head_A", "head_B",
+                     "LCA_index", "A_index", "B_index")
+
         def __init__(self, header_LCA, header_A, header_B):
-            # For processing, also store an enumerated version, ie. lists
-            # of (column number, header name) tuples
-            self.LCA = [x for x in enumerate(header_LCA)]
-            self.A = [x for x in enumerate(header_A)]
-            self.B = [x for x in enumerate(header_B)]
+            # The lists of header names being merged.  A column's
+            # number in its source file is simply its position in the
+            # list.
+            self.LCA = header_LCA
+            self.A = header_A
+            self.B = header_B
 
             # As we process columns we will gradually consume entries
-            # from the three LCA, A and B lists.  But maintain a copy
-            # of the original lists too, so that we can extract column
-            # keys for each file even when keys are moving around
-            # between files.
-
-            self.orig_LCA = self.LCA
-            self.orig_A = self.A
-            self.orig_B = self.B
+            # from the three LCA, A and B lists.  Rather than copying
+            # each list every time we step past its first entry, we
+            # keep a cursor position into each list: entries before
+            # the cursor have been processed already.
+
+            self.LCA_pos = 0
+            self.A_pos = 0
+            self.B_pos = 0
+
+            # Columns can also be consumed out of order (when we emit
+            # a moved column).  Record those names here rather than
+            # deleting them from the lists; any consumed entries are
+            # simply skipped when they reach the cursor.
+
+            self.consumed = set()
+
+            # The head entry of each list is cached between passes of
+            # the merge loop; most passes only move one or two of the
+            # cursors, so the others need not be looked up again.
+            # None means the cached head is stale.
+
+            self.head_LCA = None
+            self.head_A = None
+            self.head_B = None
+
+            # We still need to extract column keys for each file even
+            # when keys are moving around between files, so index the
+            # original column numbers by name (the names have already
+            # been made unique.)
+
+            self.LCA_index = {name: column
+                              for column, name in enumerate(header_LCA)}
+            self.A_index = {name: column
+                            for column, name in enumerate(header_A)}
+            self.B_index = {name: column
+                            for column, name in enumerate(header_B)}
 
         def no_more_input(self):
             """
             Test if we have reached the end of the input (ie. we have
             consumed all columns for all input files)
             """
-            return self.LCA == [] and self.A == [] and self.B == []
+            return (self.next_LCA()[1] is None and
+                    self.next_A()[1] is None and
+                    self.next_B()[1] is None)
+
+        def __skip(self, headerlist, pos):
+            """
+            Return the position of the first entry at or after pos
+            which has not already been consumed.
+            """
+            consumed = self.consumed
+            while pos < len(headerlist) and headerlist[pos] in consumed:
+                pos += 1
+            return pos
 
         @staticmethod
-        def __next(headerlist):
+        def __next(headerlist, pos):
             """
             Return the next entry for a given list of input columns.
 
@@ -77,51 +131,61 @@ class Headers:
             Returns (None, None) if there are no columns left to
             process in the given input file.
             """
-            if headerlist == []:
+            if pos >= len(headerlist):
                 return (None, None)
-            return headerlist[0]
+            return (pos, headerlist[pos])
 
         def show(self):
-            print ("State: LCA", self.LCA, "A", self.A, "B", self.B)
+            def pending(headerlist, pos):
+                return [x for x in enumerate(headerlist)
+                        if x[0] >= pos and x[1] not in self.consumed]
+
+            print ("State: LCA", pending(self.LCA, self.LCA_pos),
+                   "A", pending(self.A, self.A_pos),
+                   "B", pending(self.B, self.B_pos))
 
         def next_LCA(self):
-            return self.__next(self.LCA)
+            if self.head_LCA is None:
+                self.LCA_pos = self.__skip(self.LCA, self.LCA_pos)
+                self.head_LCA = self.__next(self.LCA, self.LCA_pos)
+            return self.head_LCA
 
         def next_A(self):
-            return self.__next(self.A)
+            if self.head_A is None:
+                self.A_pos = self.__skip(self.A, self.A_pos)
+                self.head_A = self.__next(self.A, self.A_pos)
+            return self.head_A
 
         def next_B(self):
-            return self.__next(self.B)
+            if self.head_B is None:
+                self.B_pos = self.__skip(self.B, self.B_pos)
+                self.head_B = self.__next(self.B, self.B_pos)
+            return self.head_B
 
         def advance_LCA(self):
-            self.LCA = self.LCA[1:]
+            self.LCA_pos += 1
+            self.head_LCA = None
 
         def advance_A(self):
-            self.A = self.A[1:]
+            self.A_pos += 1
+            self.head_A = None
 
         def advance_B(self):
-            self.B = self.B[1:]
-
-        @staticmethod
-        def find_column(list, column):
-            try:
-                entry = next(x for x in list if x[1] == column)
-                return entry[0]
-            except StopIteration:
-                return None
-
-        @staticmethod
-        def __consume1(list, name):
-            try:
-                entry = next(x for x in list if x[1] == name)
-                list.remove(entry)
-            except StopIteration:
-                pass
+            self.B_pos += 1
+            self.head_B = None
 
         def consume(self, name):
-            self.__consume1(self.LCA, name)
-            self.__consume1(self.A, name)
-            self.__consume1(self.B, name)
+            self.consumed.add(name)
+
+            # A consumed name only changes the head of a list if it
+            # is currently at that head; otherwise it is skipped
+            # later on when the cursor reaches it.
+            if self.head_LCA is not None and self.head_LCA[1] == name:
+                self.head_LCA = None
+            if self.head_A is not None and self.head_A[1] == name:
+                self.head_A = None
+            if self.head_B is not None and self.head_B[1] == name:
+                self.head_B = None
 
     # We expect a CSV file's header to be well-formed: to have a
     # unique, non-empty name for each column.
@@ -136,25 +200,29 @@ class Headers:
 
     @staticmethod
     def _uniquify(headers):
-        seen = set()
-        output = []
+        # A single dict records both that a name has been seen and
+        # how many duplicates of it we have renamed so far.
+        #
+        # Names are interned, so the many comparisons between column
+        # names from the three files during merging can short-cut on
+        # identity.
+        intern = sys.intern
         count = {}
+        output = []
 
         for h in headers:
             if h == "":
                 h = "[*unlabeled*]"
 
-            if h in seen:
-                if h not in count:
-                    count[h] = 0
-
-                count[h] = count[h] + 1
-                h = f"{h}[{count[h]}]"
-
+            n = count.get(h)
+            if n is None:
+                count[h] = 0
             else:
-                seen.add(h)
+                n += 1
+                count[h] = n
+                h = f"{h}[{n}]"
 
-            output.append(h)
+            output.append(intern(h))
 
         return output
 
@@ -178,14 +246,47 @@ class Headers:
 
         self.need_remapping = not (self.LCA == self.A == self.B)
 
+        # Most merges do not touch the header at all.  In that case
+        # every output column maps straight back to the same column in
+        # each input, so we can skip the merge walk below entirely.
+
+        if not self.need_remapping:
+            self.header_map = [HeaderMap(name, column, column, column)
+                               for column, name in enumerate(header_LCA)]
+            self.headers = list(header_LCA)
+            logging.debug("Header map: identical headers, %d columns",
+                          len(self.headers))
+            return
+
         state = Headers.__State(header_LCA, header_A, header_B)
 
+        # The loop below repeatedly asks whether a column exists
+        # anywhere in a given input file; the state's name indexes
+        # answer that without scanning the header lists.
+
+        in_LCA = state.LCA_index
+        in_A = state.A_index
+        in_B = state.B_index
+
+        # Columns at the start of the header which are the same in
+        # all three files map straight across, so emit those in bulk
+        # and start the merge walk at the first difference.
+
+        common = min(len(header_LCA), len(header_A), len(header_B))
+        prefix = 0
+        while (prefix < common and
+               header_LCA[prefix] == header_A[prefix] == header_B[prefix]):
+            prefix += 1
+
+        state.LCA_pos = state.A_pos = state.B_pos = prefix
+
         #
         # Now we walk through the headers from all three files,
         # constructing the final destination header list
         #
 
-        output = []
+        output = [HeaderMap(header_LCA[column], column, column, column)
+                  for column in range(prefix)]
 
         while not state.no_more_input():
 
@@ -225,8 +326,7 @@ class Headers:
                 # If it was in the original file in a different order,
                 # then remove it from the working list so we don't try
                 # to deal with it again
-                if next_A in self.LCA:
-                    where_in_LCA = state.find_column(state.LCA, next_A)
+                if next_A in in_LCA:
                     map = HeaderMap.from_state(state, next_A)
                     output.append(map)
 
@@ -278,7 +378,7 @@ class Headers:
                 # LCA: P Q R S
                 # A:   P Q R S
                 # B:   P R S ("Q" deleted from side B)
-                if not next_A in self.B:
+                if not next_A in in_B:
                     # Don't construct a map for the key, as the column
                     # is deleted; simply consume the removed key and
                     # continue
@@ -292,7 +392,7 @@ class Headers:
                 # LCA: P Q R S
                 # A:   P Q R S
                 # B:   P S Q R ("S" moved earlier in column list. next_B is "S")
-                if next_B in self.A:
+                if next_B in in_A:
                     # FIXME
                     # We should really honour the position in A if A
                     # and B have both moved the column.
@@ -337,7 +437,7 @@ class Headers:
                 # LCA: P Q R S
                 # A:   P R S ("Q" deleted from side A)
                 # B:   P Q R S
-                if not next_B in self.A:
+                if not next_B in in_A:
                     # Don't construct a map for the key, as the column
                     # is deleted; simply consume the removed key and
                     # continue
@@ -351,7 +451,7 @@ class Headers:
                 # LCA: P Q R S
                 # A:   P S Q R ("S" moved earlier in column list. next_A is "S")
                 # B:   P Q R S
-                if next_A in self.B:
+                if next_A in in_B:
                     # Emit the key in the current position, and
                     # consume it from further processing.
                     map = HeaderMap.from_state(state, next_A)
@@ -405,11 +505,14 @@ class Headers:
         self.header_map = output
         self.headers = [h.name for h in output]
 
-        logging.debug("Header map:")
-        for column, map in enumerate(self.header_map):
-            logging.debug('  Column %d ("%s"): from LCA %s, A %s, B %s' %
-                          (column, map.name,
-                           map.LCA_column, map.A_column, map.B_column))
+        # Don't walk (and format) the whole map unless debug logging
+        # is actually enabled.
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Header map:")
+            for column, map in enumerate(self.header_map):
+                logging.debug('  Column %d ("%s"): from LCA %s, A %s, B %s',
+                              column, map.name,
+                              map.LCA_column, map.A_column, map.B_column)
 
     # For 3-way merge, we only care about mapping which columns appear
     # where in the output.
@@ -424,38 +527,65 @@ class Headers:
             return self.full_output_map
 
         def add_to_output_map(key):
-            """Add a given key to the output map, also removing that key from the
-            list of outstanding keys in each key source"""
-
-            nonlocal output_map, left_in_LCA, left_in_A, left_in_B, left_in_map, state;
+            """Add a given key to the output map, also marking that key as no
+            longer outstanding in each key source"""
 
             map = HeaderMap.from_state(state, key)
             output_map.append(map)
+            added.add(key)
+
+        def next_outstanding(headerlist, pos):
+            """Return the position of the first key at or after pos that has
+            not yet been added to the output map"""
 
-            if map.LCA_column != None:
-                left_in_LCA.remove((map.LCA_column, key))
-            if map.A_column != None:
-                left_in_A.remove((map.A_column, key))
-            if map.B_column != None:
-                left_in_B.remove((map.A_column, key))
+            while pos < len(headerlist) and headerlist[pos] in added:
+                pos += 1
+            return pos
 
-            if key in left_in_map:
-                left_in_map.remove(key)
+        def next_missing(headerlist):
+            """For each position in a list of keys, return the position of
+            the first missing key at or after it (or the length of the
+            list if there are no more missing keys)"""
+
+            result = [len(headerlist)] * (len(headerlist) + 1)
+            for pos in range(len(headerlist) - 1, -1, -1):
+                if headerlist[pos] in missing_headers:
+                    result[pos] = pos
+                else:
+                    result[pos] = result[pos + 1]
+            return result
 
         header_LCA = self.LCA
         header_A = self.A
         header_B = self.B
 
         all_headers = set(header_LCA) | set(header_A) | set(header_B)
-        map_headers = [map.name for map in self.header_map]
+        map_headers = self.headers
         missing_headers = all_headers.difference(map_headers)
 
-        # Make a copy of all the keys still left in headers A and B
-        left_in_LCA = list(enumerate(header_LCA))
-        left_in_A = list(enumerate(header_A))
-        left_in_B = list(enumerate(header_B))
+        # If no columns have been removed, there is nothing to
+        # interleave: the full map is just the output map.
+
+        if not missing_headers:
+            self.full_output_map = list(self.header_map)
+            return self.full_output_map
+
+        # Rather than copying and removing keys from lists of the
+        # leftover keys in each of LCA, A, B and the main output map,
+        # keep a cursor into each list and a set of the keys added so
+        # far; keys that have already been added are skipped when
+        # they reach the cursor.
 
-        left_in_map = list(map_headers)
+        pos_LCA = pos_A = pos_B = pos_map = 0
+        added = set()
+
+        # The leftover lists only matter when a missing key reaches
+        # their cursor, so find the missing keys' positions up front
+        # rather than testing each key against the set as we go.
+
+        missing_LCA = next_missing(header_LCA)
+        missing_A = next_missing(header_A)
+        missing_B = next_missing(header_B)
 
         output_map = []
 
@@ -476,27 +606,33 @@ class Headers:
 
         state = Headers.__State(header_LCA, header_A, header_B)
 
-        while left_in_LCA or left_in_A or left_in_B:
+        while True:
 
-            if left_in_LCA:
-                _, next_LCA = left_in_LCA[0]
-                if next_LCA in missing_headers:
-                    add_to_output_map(next_LCA)
-                    continue
+            pos_LCA = next_outstanding(header_LCA, pos_LCA)
+            pos_A = next_outstanding(header_A, pos_A)
+            pos_B = next_outstanding(header_B, pos_B)
 
-            if left_in_A:
-                _, next_A = left_in_A[0]
-                if next_A in missing_headers:
-                    add_to_output_map(next_A)
-                    continue
+            left_in_LCA = pos_LCA < len(header_LCA)
+            left_in_A = pos_A < len(header_A)
+            left_in_B = pos_B < len(header_B)
 
-            if left_in_B:
-                _, next_B = left_in_B[0]
-                if next_B in missing_headers:
-                    add_to_output_map(next_B)
-                    continue
+            if not (left_in_LCA or left_in_A or left_in_B):
+                break
+
+            if left_in_LCA and missing_LCA[pos_LCA] == pos_LCA:
+                add_to_output_map(header_LCA[pos_LCA])
+                continue
+
+            if left_in_A and missing_A[pos_A] == pos_A:
+                add_to_output_map(header_A[pos_A])
+                continue
+
+            if left_in_B and missing_B[pos_B] == pos_B:
+                add_to_output_map(header_B[pos_B])
+                continue
 
-            next_map = left_in_map[0]
+            pos_map = next_outstanding(map_headers, pos_map)
+            next_map = map_headers[pos_map]
             add_to_output_map(next_map)
 
         self.full_output_map = output_map
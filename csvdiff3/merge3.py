@@ -4,8 +4,8 @@ import sys
 import os
 import logging
 import re
-import random
-import string
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 
 from colorama import Fore, Style
 
@@ -14,14 +14,19 @@ from .headers import Headers
 from .tools.options import *
 from .output import Merge3OutputDriver
 
-class ConflictError(Exception):
-    pass
-
 class PrimaryKeyError(MergeFailedError):
     def __init__(self, message, *args):
         super(PrimaryKeyError, self).__init__(message, *args)
 
 class __State:
+    __slots__ = ("file_LCA", "file_A", "file_B",
+                 "headers", "output_driver", "header_columns",
+                 "cursor_LCA", "cursor_A", "cursor_B",
+                 "file_has_conflicts", "colour", "reformat_all",
+                 "colour_red", "colour_green", "colour_cyan",
+                 "colour_bold", "colour_unbold", "colour_reset",
+                 "debug_logging")
+
     def __init__(self, file_LCA, file_A, file_B,
                  headers, output_driver,
                  colour = False,
@@ -34,6 +39,12 @@ class __State:
         self.headers = headers
         self.output_driver = output_driver
 
+        # merge_one_line() walks the header map for every line it
+        # merges field by field, so unpack the source columns of each
+        # output column once up-front.
+        self.header_columns = [(map, map.LCA_column, map.A_column, map.B_column)
+                               for map in headers.header_map]
+
         self.cursor_LCA = Cursor(file_LCA)
         self.cursor_A = Cursor(file_A)
         self.cursor_B = Cursor(file_B)
@@ -43,14 +54,28 @@ class __State:
         self.colour = colour
         self.reformat_all = reformat_all
 
+        # The output drivers ask for colour codes for every diff line
+        # and conflict they write, so resolve them once here.
+        if colour:
+            self.colour_red = Fore.RED
+            self.colour_green = Fore.GREEN
+            self.colour_cyan = Fore.CYAN
+            self.colour_bold = Style.BRIGHT
+            self.colour_unbold = Style.NORMAL
+            self.colour_reset = Style.RESET_ALL
+        else:
+            self.colour_red = self.colour_green = self.colour_cyan = ""
+            self.colour_bold = self.colour_unbold = self.colour_reset = ""
+
+        # Some debug messages are logged for every line merged, and
+        # are expensive to format even when logging will discard
+        # them; check once whether debug logging is enabled at all.
+        self.debug_logging = logging.getLogger().isEnabledFor(logging.DEBUG)
+
     def EOF(self):
-        if not self.cursor_LCA.EOF():
-            return False
-        if not self.cursor_A.EOF():
-            return False
-        if not self.cursor_B.EOF():
-            return False
-        return True
+        return (self.cursor_LCA.EOF() and
+                self.cursor_A.EOF() and
+                self.cursor_B.EOF())
 
     def advance_all(self):
         self.cursor_LCA.advance()
@@ -62,33 +87,31 @@ class __State:
         self.cursor_A.consume(key, line_A)
         self.cursor_B.consume(key, line_B)
 
-    def text_if_colour_enabled(self, text):
-        if not self.colour:
-            return ""
-        return text
-
     def text_red(self):
-        return self.text_if_colour_enabled(Fore.RED)
+        return self.colour_red
 
     def text_green(self):
-        return self.text_if_colour_enabled(Fore.GREEN)
+        return self.colour_green
 
     def text_cyan(self):
-        return self.text_if_colour_enabled(Fore.CYAN)
+        return self.colour_cyan
 
     def text_bold(self):
-        return self.text_if_colour_enabled(Style.BRIGHT)
+        return self.colour_bold
 
     def text_unbold(self):
-        return self.text_if_colour_enabled(Style.NORMAL)
+        return self.colour_unbold
 
     def text_reset(self):
-        return self.text_if_colour_enabled(Style.RESET_ALL)
+        return self.colour_reset
 
     @staticmethod
     def dump_one_cursor(name, cursor):
-        logging.debug("cursor %s at linenr %d:" %
-                      (name, cursor.linenr))
+        # Don't bother walking the backlog if nothing will be logged
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+
+        logging.debug("cursor %s at linenr %d:", name, cursor.linenr)
 
         # Dump the current line (unless EOF)
         if cursor.EOF():
@@ -102,26 +125,26 @@ class __State:
             except IndexError:
                 key = ""
 
-            logging.debug("  linenr %d, key %s, consumed %s" %
-                          (line.linenr, key, line.is_consumed))
+            logging.debug("  linenr %d, key %s, consumed %s",
+                          line.linenr, key, line.is_consumed)
 
             if line.LCA_backlog_match:
                 logging.debug("    has background match in LCA "
                               f"at line {line.LCA_backlog_match.linenr}")
 
-            match_A = getattr(line, "backlog_match_in_A", None)
-            match_B = getattr(line, "backlog_match_in_B", None)
+            match_A = line.backlog_match_in_A
+            match_B = line.backlog_match_in_B
             if match_A or match_B:
                 logging.debug("    matches "
-                              f"line {Line.linenr(match_A)} in A, "
-                              f"line {Line.linenr(match_B)} in B")
+                              f"line {Line.debug_linenr(match_A)} in A, "
+                              f"line {Line.debug_linenr(match_B)} in B")
 
 
         # And dump the backlog
         logging.debug(f"  backlog: {len(cursor.backlog)}")
         for key in cursor.backlog:
             logging.debug(f"  backlog key {key}")
-            for line in cursor.backlog.getlist(key):
+            for line in cursor.backlog[key]:
                 logging.debug(f"  backlog linenr {line.linenr}, text '{line.text.strip()}' " +
                               f"is {'not ' if not line.is_consumed else ''}consumed")
 
@@ -140,9 +163,7 @@ class __State:
         if not os.path.exists(path):
             return
 
-        prefix = ''.join(random.choices(string.ascii_uppercase
-                                        + string.ascii_lowercase
-                                        + string.digits, k=6))
+        prefix = secrets.token_hex(3)
         prefix = os.path.join(path, "csvmerge3-"+prefix)
 
         self.file_LCA.dump("LCA", prefix)
@@ -157,6 +178,8 @@ class Conflict:
     We accumulate conflicts as we merge and then output the results at
     the end of the line.
     """
+    __slots__ = ("val_A", "val_B", "column")
+
     def __init__(self, val_A, val_B, column):
         self.val_A = val_A
         self.val_B = val_B
@@ -166,6 +189,8 @@ class Conflicts:
     """
     Maintain a set of conflicts while we merge a single line.
     """
+    __slots__ = ("line_LCA", "line_A", "line_B", "conflicts")
+
     def __init__(self, line_LCA, line_A, line_B):
         self.line_LCA = line_LCA
         self.line_A = line_A
@@ -205,10 +230,11 @@ def merge3_next(state):
     line_A = state.cursor_A[0]
     line_B = state.cursor_B[0]
 
-    logging.debug("Next iteration: lines/keys are "
-                  f"{Line.linenr(line_LCA)} [{key_LCA}] "
-                  f"{Line.linenr(line_A)} [{key_A}] "
-                  f"{Line.linenr(line_B)} [{key_B}]")
+    if state.debug_logging:
+        logging.debug("Next iteration: lines/keys are "
+                      f"{Line.debug_linenr(line_LCA)} [{key_LCA}] "
+                      f"{Line.debug_linenr(line_A)} [{key_A}] "
+                      f"{Line.debug_linenr(line_B)} [{key_B}]")
 
     # Now the real work starts: figure how to handle the many, various
     # possibilities where the next lines in each source file may have
@@ -227,11 +253,11 @@ def merge3_next(state):
 
         LCA_backlog_line = line_A.LCA_backlog_match
 
-        logging.debug(f"  Action: match A in backlog (key {key_A}, "
-                      f"LCA line {LCA_backlog_line.linenr})")
+        logging.debug("  Action: match A in backlog (key %s, LCA line %d)",
+                      key_A, LCA_backlog_line.linenr)
 
         assert LCA_backlog_line.linenr < state.cursor_LCA.linenr
-        assert state.cursor_LCA.backlog[key_A] == LCA_backlog_line
+        assert state.cursor_LCA.backlog_first(key_A) is LCA_backlog_line
 
         # NB. we must *NOT* use "A_match_in_B" here to determine if
         # there's a matching line in B to use for the merge.  That
@@ -247,8 +273,9 @@ def merge3_next(state):
 
         backlog_match_in_B = LCA_backlog_line.backlog_match_in_B
 
-        logging.debug(f"    Matches line {Line.linenr(backlog_match_in_B)} in B")
-        merge_one_line(state, LCA_backlog_line, line_A, backlog_match_in_B)
+        logging.debug("    Matches line %s in B",
+                      Line.debug_linenr(backlog_match_in_B))
+        merge_one_line(state, key_A, LCA_backlog_line, line_A, backlog_match_in_B)
         state.consume(key_A, LCA_backlog_line, line_A, backlog_match_in_B)
         return
 
@@ -258,16 +285,17 @@ def merge3_next(state):
 
         LCA_backlog_line = line_B.LCA_backlog_match
 
-        logging.debug(f"  Action: match B in backlog (key {key_B}, "
-                      f"LCA line {LCA_backlog_line.linenr})")
+        logging.debug("  Action: match B in backlog (key %s, LCA line %d)",
+                      key_B, LCA_backlog_line.linenr)
 
         assert LCA_backlog_line.linenr < state.cursor_LCA.linenr
-        assert state.cursor_LCA.backlog[key_B] == LCA_backlog_line
+        assert state.cursor_LCA.backlog_first(key_B) is LCA_backlog_line
 
         backlog_match_in_A = LCA_backlog_line.backlog_match_in_A
 
-        logging.debug(f"    Matches line {Line.linenr(backlog_match_in_A)} in A")
-        merge_one_line(state, LCA_backlog_line, backlog_match_in_A, line_B)
+        logging.debug("    Matches line %s in A",
+                      Line.debug_linenr(backlog_match_in_A))
+        merge_one_line(state, key_B, LCA_backlog_line, backlog_match_in_A, line_B)
         state.consume(key_B, LCA_backlog_line, backlog_match_in_A, line_B)
         return
 
@@ -281,14 +309,23 @@ def merge3_next(state):
     # are in largely the same order.
 
     if key_LCA == key_A == key_B:
-        merge_one_line(state, line_LCA, line_A, line_B)
+        merge_one_line(state, key_LCA, line_LCA, line_A, line_B)
         state.consume(key_LCA, line_LCA, line_A, line_B)
         return
 
+    # Two of the three keys are often the same (eg. a line changed or
+    # moved in only one of A and B, or in the same way in both.)
+    # Nothing changes in the cursors while we are looking up matches,
+    # so a lookup of the same key in the same file gives the same
+    # answer, and we reuse it rather than searching again.
+
     A_match_in_LCA, A_distance_in_LCA = find_next_matching_line(key_A, state.cursor_LCA)
     A_match_in_B, A_distance_in_B = find_next_matching_line(key_A, state.cursor_B)
 
-    B_match_in_LCA, B_distance_in_LCA = find_next_matching_line(key_B, state.cursor_LCA)
+    if key_B == key_A:
+        B_match_in_LCA, B_distance_in_LCA = A_match_in_LCA, A_distance_in_LCA
+    else:
+        B_match_in_LCA, B_distance_in_LCA = find_next_matching_line(key_B, state.cursor_LCA)
     B_match_in_A, B_distance_in_A = find_next_matching_line(key_B, state.cursor_A)
 
     # Next, we look to see if there is an insert or delete to process.
@@ -299,29 +336,35 @@ def merge3_next(state):
     if key_A and not A_match_in_LCA:
         # The key in A is not present in LCA: it's an insert.
 
-        logging.debug(f"  Action: insert A (key {key_A})")
-        merge_one_line(state, None, line_A, A_match_in_B)
+        logging.debug("  Action: insert A (key %s)", key_A)
+        merge_one_line(state, key_A, None, line_A, A_match_in_B)
         state.consume(key_A, None, line_A, A_match_in_B)
         return
 
     if key_B and not B_match_in_LCA:
         # The key at A is not an insert, but the key at B is
 
-        logging.debug(f"  Action: insert B (key {key_B})")
-        merge_one_line(state, None, B_match_in_A, line_B)
+        logging.debug("  Action: insert B (key %s)", key_B)
+        merge_one_line(state, key_B, None, B_match_in_A, line_B)
         state.consume(key_B, None, B_match_in_A, line_B)
         return
 
     # Not an insert... is there a delete?
 
-    LCA_match_in_A, LCA_distance_in_A = find_next_matching_line(key_LCA, state.cursor_A)
-    LCA_match_in_B, LCA_distance_in_B = find_next_matching_line(key_LCA, state.cursor_B)
+    if key_LCA == key_B:
+        LCA_match_in_A, LCA_distance_in_A = B_match_in_A, B_distance_in_A
+    else:
+        LCA_match_in_A, LCA_distance_in_A = find_next_matching_line(key_LCA, state.cursor_A)
+    if key_LCA == key_A:
+        LCA_match_in_B, LCA_distance_in_B = A_match_in_B, A_distance_in_B
+    else:
+        LCA_match_in_B, LCA_distance_in_B = find_next_matching_line(key_LCA, state.cursor_B)
 
     if not LCA_match_in_A:
         # The key in LCA is no longer findable in A.  It's a delete.
 
-        logging.debug(f"  Action: delete A (key {key_LCA})")
-        merge_one_line(state, line_LCA, None, LCA_match_in_B)
+        logging.debug("  Action: delete A (key %s)", key_LCA)
+        merge_one_line(state, key_LCA, line_LCA, None, LCA_match_in_B)
         state.consume(key_LCA, line_LCA, None, LCA_match_in_B)
         return
 
@@ -329,8 +372,8 @@ def merge3_next(state):
         # The key in LCA is present in A but not in B; again, it's a
         # delete.
 
-        logging.debug(f"  Action: delete B (key {key_LCA})")
-        merge_one_line(state, line_LCA, LCA_match_in_A, None)
+        logging.debug("  Action: delete B (key %s)", key_LCA)
+        merge_one_line(state, key_LCA, line_LCA, LCA_match_in_A, None)
         state.consume(key_LCA, line_LCA, LCA_match_in_A, None)
         return
 
@@ -430,11 +473,11 @@ def merge3_next(state):
             # move, so push LCA to the backlog (and B too if it has
             # the same key as LCA.)
 
-            logging.debug(f"    Push LCA line {line_LCA.linenr} to backlog")
+            logging.debug("    Push LCA line %d to backlog", line_LCA.linenr)
             state.cursor_LCA.move_to_backlog()
 
             if key_LCA == key_B:
-                logging.debug(f"    Push B line {line_B.linenr} to backlog")
+                logging.debug("    Push B line %d to backlog", line_B.linenr)
                 state.cursor_B.move_to_backlog()
 
             # We also mark the future line in A as having a backlog
@@ -442,8 +485,8 @@ def merge3_next(state):
             # don't match the same line twice
 
             LCA_match_in_A.LCA_backlog_match = line_LCA
-            logging.debug(f"    Set backlog match in A at line "
-                          f"{Line.linenr(LCA_match_in_A)}")
+            logging.debug("    Set backlog match in A at line %s",
+                          Line.debug_linenr(LCA_match_in_A))
             line_LCA.backlog_match_in_A = LCA_match_in_A
 
             # and we need to look forward for a similar matching line
@@ -451,8 +494,8 @@ def merge3_next(state):
 
             if LCA_match_in_B:
                 LCA_match_in_B.LCA_backlog_match = line_LCA
-                logging.debug(f"    Found backlog match in B at line "
-                              f"{Line.linenr(LCA_match_in_B)}")
+                logging.debug("    Found backlog match in B at line %s",
+                              Line.debug_linenr(LCA_match_in_B))
             line_LCA.backlog_match_in_B = LCA_match_in_B
 
             return
@@ -461,9 +504,9 @@ def merge3_next(state):
         # backwards more; treat it as a backwards move, and do a
         # forced emit right now of the matching lines for key_A
 
-        logging.debug(f"  Action: forced emit A ({key_A})")
+        logging.debug("  Action: forced emit A (%s)", key_A)
 
-        merge_one_line(state, A_match_in_LCA, line_A, A_match_in_B)
+        merge_one_line(state, key_A, A_match_in_LCA, line_A, A_match_in_B)
         state.consume(key_A, A_match_in_LCA, line_A, A_match_in_B)
         return
 
@@ -487,9 +530,9 @@ def merge3_next(state):
         # move, so push LCA to the backlog (and A too, as by now it
         # must have the same key as LCA.)
 
-        logging.debug(f"    Push LCA line {key_LCA} to backlog")
+        logging.debug("    Push LCA line %s to backlog", key_LCA)
         state.cursor_LCA.move_to_backlog()
-        logging.debug(f"    Push A line {key_A} to backlog")
+        logging.debug("    Push A line %s to backlog", key_A)
         state.cursor_A.move_to_backlog()
 
         # We also mark the future line in B as having a backlog
@@ -497,8 +540,8 @@ def merge3_next(state):
         # don't match the same line twice
 
         LCA_match_in_B.LCA_backlog_match = line_LCA
-        logging.debug(f"    Set backlog match in B at line "
-                      f"{Line.linenr(LCA_match_in_B)}")
+        logging.debug("    Set backlog match in B at line %s",
+                      Line.debug_linenr(LCA_match_in_B))
         line_LCA.backlog_match_in_B = LCA_match_in_B
 
         # and we need to look forward for a similar matching line
@@ -506,8 +549,8 @@ def merge3_next(state):
 
         if LCA_match_in_A:
             LCA_match_in_A.LCA_backlog_match = line_LCA
-            logging.debug(f"    Found backlog match in A at line "
-                          f"{Line.linenr(LCA_match_in_A)}")
+            logging.debug("    Found backlog match in A at line %s",
+                          Line.debug_linenr(LCA_match_in_A))
         line_LCA.backlog_match_in_A = LCA_match_in_A
 
         return
@@ -516,9 +559,9 @@ def merge3_next(state):
     # backwards more; treat it as a backwards move, and do a
     # forced emit right now of the matching lines for key_B
 
-    logging.debug(f"  Action: forced emit B ({key_B})")
+    logging.debug("  Action: forced emit B (%s)", key_B)
 
-    merge_one_line(state, B_match_in_LCA, B_match_in_A, line_B)
+    merge_one_line(state, key_B, B_match_in_LCA, B_match_in_A, line_B)
     state.consume(key_B, B_match_in_LCA, B_match_in_A, line_B)
 
     return
@@ -546,32 +589,6 @@ def find_next_matching_line(key, cursor):
     return (line, distance)
 
 
-def lookup_field(line, column):
-    """
-    Lookup the value of a given (numbered) column in a given Line
-
-    Returns None if either the column or the line is None
-    """
-
-    # During merge, it is not guaranteed that each input file to the
-    # merge has a matching line...
-
-    if not line:
-        return None
-
-    # ...or that the input line has a column of the given name...
-
-    if column == None:
-        return None
-
-    # ...or that the line in question bothers to supply every required
-    # column
-
-    try:
-        return line.row[column]
-    except IndexError:
-        return None
-
 def changed_line_is_compatible(before, after):
     """
     Test whether two versions of a Line are in conflict or not.  If
@@ -592,44 +609,34 @@ def changed_line_is_compatible(before, after):
         return True
     return False
 
-def choose3(LCAval, Aval, Bval):
+def lines_are_compatible(line_LCA, line_A, line_B):
     """
-    Given three arbitrary values representing some property of the LCA
-    and A/B branches, choose an appropriate output value.
-
-    The usual rules for 3-way merge are used:
-    * if A has changed LCA and B has not, then inherit the change from
-      A
-    * if B has changed LCA and A has not, then inherit the change from
-      B
-    * If both A and B differ from the LCA value but A and B are the
-      same, then choose that value.
-    * If A and B are different from each other and different from LCA,
-      then we we have a conflict.  This also includes the case where
-      either A or B is None, indicating that the row was deleted on
-      one side but modified on the other.
-
-      Raise a ConflictError exception in this case.
+    Test whether the LCA, A and B versions of a Line are all mutually
+    compatible (see changed_line_is_compatible().)
     """
-    if LCAval == Aval:
-        return Bval
-    if LCAval == Bval:
-        return Aval
-    if Aval == Bval:
-        return Aval
-    raise ConflictError
-
-def merge_one_line(state, line_LCA, line_A, line_B):
+    # Most lines are unchanged in all three files, so check for that
+    # with a single chained text comparison before falling back to
+    # the pairwise tests.
+    if line_LCA and line_A and line_B and \
+       line_LCA.text == line_A.text == line_B.text:
+        return True
+
+    return (changed_line_is_compatible(line_LCA, line_A) and
+            changed_line_is_compatible(line_LCA, line_B) and
+            changed_line_is_compatible(line_A, line_B))
+
+def merge_one_line(state, key, line_LCA, line_A, line_B):
     """
     Perform field-by-field merging of LCA, A and B versions of a given
-    line, sharing a common primary key.
+    line, sharing the common primary key "key".
 
     Any or all of the files may be missing a value for one or more
     fields, in which case an empty string is used for those fields.
     """
 
-    logging.debug("  Action: merge_one_line(LCA %s, A %s, B %s)" %
-                  (format(line_LCA), format(line_A), format(line_B)))
+    if state.debug_logging:
+        logging.debug("  Action: merge_one_line(LCA %s, A %s, B %s)" %
+                      (format(line_LCA), format(line_A), format(line_B)))
 
     # We call the merge function for deleted rows, just in case
     # the delete conflicts with an update/modify.
@@ -641,35 +648,30 @@ def merge_one_line(state, line_LCA, line_A, line_B):
 
     # Check that we have the right key on all three lines.  We
     # *really* do not want to merge the wrong lines by mistake!
+    # (Each line's key was cached when its file was loaded.)
 
-    key_LCA = line_LCA and line_LCA.get_field(state.cursor_LCA.file.key_index)
-    key_A = line_A and line_A.get_field(state.cursor_A.file.key_index)
-    key_B = line_B and line_B.get_field(state.cursor_B.file.key_index)
-
-    key = key_LCA or key_A or key_B
-
-    if key_LCA:
-        assert key_LCA == key
-    if key_A:
-        assert key_A == key
-    if key_B:
-        assert key_B == key
+    if line_LCA:
+        assert line_LCA.key == key
+    if line_A:
+        assert line_A.key == key
+    if line_B:
+        assert line_B.key == key
 
     # First, check if the corresponding lines of each input file have
     # the exact same text.  If they are all the same, then that is our
     # next output line, and we will avoid reformatting.
 
-    if changed_line_is_compatible(line_LCA, line_A) and \
-       changed_line_is_compatible(line_LCA, line_B) and \
-       changed_line_is_compatible(line_A, line_B):
+    output_driver = state.output_driver
+
+    if lines_are_compatible(line_LCA, line_A, line_B):
 
         if is_delete:
-            logging.debug("  Skipping deleted row: %s" % line_LCA.row)
+            logging.debug("  Skipping deleted row: %s", line_LCA.row)
             # We will still send an empty line to the output driver so
             # that diff2/3 outputs can record the deleted line.
-            state.output_driver.emit_text(state,
-                                          line_LCA, line_A, line_B,
-                                          None)
+            output_driver.emit_text(state,
+                                    line_LCA, line_A, line_B,
+                                    None)
             return
 
         # Don't output un-reformatted existing text if we are forcing
@@ -677,41 +679,83 @@ def merge_one_line(state, line_LCA, line_A, line_B):
 
         if not state.reformat_all:
             out_text = (line_A or line_B).text
-            # Log the output without line-terminator
-            logging.debug("  Writing exact text: %s" % out_text[0:-1])
-            state.output_driver.emit_text(state,
-                                          line_LCA, line_A, line_B,
-                                          out_text)
+            # Log the output without line-terminator (the slice copies
+            # the line, so only take it if debug logging is enabled)
+            if state.debug_logging:
+                logging.debug("  Writing exact text: %s", out_text[0:-1])
+            output_driver.emit_text(state,
+                                    line_LCA, line_A, line_B,
+                                    out_text)
             return
 
     # do field-by-field merging
     row = []
     conflicts = Conflicts(line_LCA, line_A, line_B)
 
-    for map in state.headers.header_map:
+    # During merge, it is not guaranteed that each input file to the
+    # merge has a matching line, that the input line has a given
+    # column, or that the line in question bothers to supply every
+    # required column.  Any such missing field is looked up as None.
+    #
+    # This is the innermost loop of the merge, so fetch each row and
+    # its length once here rather than per field.
+
+    row_LCA = line_LCA.row if line_LCA else ()
+    row_A = line_A.row if line_A else ()
+    row_B = line_B.row if line_B else ()
+
+    len_LCA = len(row_LCA)
+    len_A = len(row_A)
+    len_B = len(row_B)
+
+    for map, column_LCA, column_A, column_B in state.header_columns:
         # The header_map maps columns in the output to the correct
         # columns in the various source files
-        value_LCA = lookup_field(line_LCA, map.LCA_column)
-        value_A = lookup_field(line_A, map.A_column)
-        value_B = lookup_field(line_B, map.B_column)
+        value_LCA = (row_LCA[column_LCA]
+                     if column_LCA is not None and column_LCA < len_LCA
+                     else None)
+        value_A = (row_A[column_A]
+                   if column_A is not None and column_A < len_A
+                   else None)
+        value_B = (row_B[column_B]
+                   if column_B is not None and column_B < len_B
+                   else None)
+
+        # Choose the output value using the usual rules for 3-way
+        # merge:
+        # * if A has changed LCA and B has not, then inherit the
+        #   change from A
+        # * if B has changed LCA and A has not, then inherit the
+        #   change from B
+        # * If both A and B differ from the LCA value but A and B are
+        #   the same, then choose that value.
+        # * If A and B are different from each other and different
+        #   from LCA, then we have a conflict.  This also includes
+        #   the case where either A or B is None, indicating that the
+        #   row was deleted on one side but modified on the other.
+        #
+        # This runs for every field of every reformatted line, so it
+        # is written out here rather than called as a function.
 
-        try:
-            value = choose3(value_LCA, value_A, value_B)
-        except ConflictError:
+        if value_LCA == value_A:
+            value = value_B
+        elif value_LCA == value_B or value_A == value_B:
+            value = value_A
+        else:
             # Need to emit a conflict marker in the output here
             conflicts.add(Conflict(value_A, value_B, map))
             value = "<conflict>"
 
-        if value == None:
+        if value is None:
             value = ""
 
         row.append(value)
 
     if conflicts:
-        logging.debug("  Writing conflicts: %s" % row)
-        state.output_driver.emit_conflicts(state,
-                                           line_LCA, line_A, line_B,
-                                           conflicts)
+        logging.debug("  Writing conflicts: %s", row)
+        output_driver.emit_conflicts(state,
+                                     line_LCA, line_A, line_B,
+                                     conflicts)
         state.file_has_conflicts = True
 
     else:
@@ -723,13 +767,13 @@ def merge_one_line(state, line_LCA, line_A, line_B):
         # is no conflict.
 
         if is_delete:
-            logging.debug("  Skipping deleted row: %s" % row)
+            logging.debug("  Skipping deleted row: %s", row)
             return
 
-        logging.debug("  Writing row: %s" % row)
-        state.output_driver.emit_csv_row(state,
-                                         line_LCA, line_A, line_B,
-                                         row)
+        logging.debug("  Writing row: %s", row)
+        output_driver.emit_csv_row(state,
+                                   line_LCA, line_A, line_B,
+                                   row)
 
 # Check whether a proposed primary key is valid for all input files.
 # The key must be present in each non-empty input file.
@@ -738,7 +782,7 @@ def key_is_valid(key, file_LCA, file_A, file_B):
     for file in file_LCA, file_A, file_B:
         if file.reader.empty:
             continue
-        if key not in file.header.row:
+        if key not in file.column_index:
             return False
 
     return True
@@ -767,13 +811,12 @@ def key_duplicates(key, file):
     if file.reader.empty:
         return 0
 
-    if key not in file.header.row:
-        return 0
-
     # Figure where this key lies in this particular input file:
 
-    column_index = file.header.row.index(next(x for x in file.header.row
-                                              if x == key))
+    column_index = file.column_index.get(key)
+    if column_index is None:
+        return 0
+
     key_values = set()
 
     # Now find all the distinct values this key has in this file
@@ -784,10 +827,9 @@ def key_duplicates(key, file):
         # but don't crash on short lines that don't contain a value
         # for this particular key.
 
-        try:
-            key_values.add(line.row[column_index])
-        except IndexError:
-            pass
+        row = line.row
+        if column_index < len(row):
+            key_values.add(row[column_index])
         lines += 1
 
     duplicates = lines - len(key_values)
@@ -888,9 +930,17 @@ def merge3(file_lca, file_a, file_b, key,
         logging.basicConfig(filename = "DEBUG.log", level = logging.DEBUG)
         logging.debug("Started new run.")
 
-    file_LCA = CSVFile(file_lca, filename = filename_LCA)
-    file_A = CSVFile(file_a, filename = filename_A)
-    file_B = CSVFile(file_b, filename = filename_B)
+    # The three input files are independent of each other, so read
+    # and parse them concurrently.
+
+    with ThreadPoolExecutor(max_workers = 3) as executor:
+        future_LCA = executor.submit(CSVFile, file_lca, filename = filename_LCA)
+        future_A = executor.submit(CSVFile, file_a, filename = filename_A)
+        future_B = executor.submit(CSVFile, file_b, filename = filename_B)
+
+        file_LCA = future_LCA.result()
+        file_A = future_A.result()
+        file_B = future_B.result()
 
     headers = Headers(file_LCA.header.row,
                       file_A.header.row,
@@ -953,9 +1003,34 @@ def merge3(file_lca, file_a, file_b, key,
                                    file_LCA[1], file_A[1], file_B[1],
                                    headers.headers, row_key = "<Column names>")
 
+    # If all three input files are exactly the same then every line
+    # would merge as an exact-text match in turn, so we can skip the
+    # per-line merge and emit the text straight away.  (The cursors
+    # are still stepped along with the output, as the output driver
+    # may look at them.)
+
+    if (not reformat_all) and \
+       file_LCA.raw_lines == file_A.raw_lines == file_B.raw_lines:
+        for linenr in range(2, file_A.last_line + 1):
+            state.cursor_LCA.linenr = linenr
+            state.cursor_A.linenr = linenr
+            state.cursor_B.linenr = linenr
+
+            line_A = file_A[linenr]
+            output_driver.emit_text(state,
+                                    file_LCA[linenr], line_A, file_B[linenr],
+                                    line_A.text)
+        output_driver.flush()
+        return 0
+
     try:
-        while not state.EOF():
-            merge3_next(state)
+        # This loop runs once per merged line, so look up its
+        # callables once rather than on every pass.
+        EOF = state.EOF
+        next_step = merge3_next
+
+        while not EOF():
+            next_step(state)
 
         state.cursor_LCA.assert_finished()
         state.cursor_A.assert_finished()
@@ -965,6 +1040,9 @@ def merge3(file_lca, file_a, file_b, key,
         state.dump_current_state()
         raise
 
+    finally:
+        output_driver.flush()
+
     if state.file_has_conflicts:
         return 1
     else:
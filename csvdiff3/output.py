@@ -67,30 +67,54 @@ class OutputDriver():
         updates in A and B."""
         pass
 
-    # Some common helper functions to assist output drivers with formatting
+    def flush(self):
+        """
+        Called once the merge is complete (or has failed), to write out
+        any output the driver is still holding.
+        """
+        pass
 
-    newline_regexp = re.compile("\n|\r\n")
+    # Some common helper functions to assist output drivers with formatting
 
     @staticmethod
-    def quote_newlines(text, replacement = "\\\\n"):
+    def quote_newlines(text, replacement = "\\n"):
         """
         Prepare a key for printing, replacing any EOL/newline
         sequences with "\n" to keep the output on a single line.
         """
-        return OutputDriver.newline_regexp.sub(replacement, format(text))
+        # Replace CRLF first so that it becomes a single "\n", not
+        # a stray CR followed by one.
+        return format(text).replace("\r\n", replacement).replace("\n", replacement)
 
 
 class Merge3OutputDriver(OutputDriver):
+    # A merge writes one small string per output line; collect them
+    # and pass them on to the output stream in large batches instead.
+
+    batch_size = 1024
+
     def __init__(self, *args, **kwargs):
         OutputDriver.__init__(self, *args, **kwargs)
-        self.writer = csv.writer(self.stream, **self.dialect_args)
+        self.pending = []
+        self.writer = csv.writer(self, **self.dialect_args)
+
+    def write(self, text):
+        pending = self.pending
+        pending.append(text)
+        if len(pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.pending.clear()
 
     def emit_text(self, state, line_LCA, line_A, line_B, text):
         # Do nothing if there is no text in the merged output
         # (ie. this line has been deleted.)
         if not text:
             return
-        self.stream.write(text)
+        self.write(text)
 
     def emit_csv_row(self, state, line_LCA, line_A, line_B, row, row_key = None):
         # Do nothing if there is no content in the merged output
@@ -110,7 +134,7 @@ class Merge3OutputDriver(OutputDriver):
         linestr = ">>>>>> %s %s\n" % \
             (state.cursor_A.file.filename,
              self.line_to_str(conflicts.line_A, state.cursor_LCA, state.cursor_A))
-        self.stream.write(linestr)
+        self.write(linestr)
 
         for c in conflicts:
             linestr = ">>>>>> %s = %s%s%s\n" % \
@@ -119,19 +143,19 @@ class Merge3OutputDriver(OutputDriver):
                  self.quote_newlines(c.val_A),
                  state.text_reset()
                 )
-            self.stream.write(linestr)
+            self.write(linestr)
 
         if conflicts.line_A:
-            self.stream.write(state.text_red())
-            self.stream.write(conflicts.line_A.text)
-            self.stream.write(state.text_reset())
+            self.write(state.text_red())
+            self.write(conflicts.line_A.text)
+            self.write(state.text_reset())
 
         # Side B next
 
         linestr = "====== %s %s\n" % \
             (state.cursor_B.file.filename,
              self.line_to_str(conflicts.line_B, state.cursor_LCA, state.cursor_B))
-        self.stream.write(linestr)
+        self.write(linestr)
 
         for c in conflicts:
             linestr = "====== %s = %s%s%s\n" % \
@@ -140,17 +164,17 @@ class Merge3OutputDriver(OutputDriver):
                  self.quote_newlines(c.val_B),
                  state.text_reset()
                 )
-            self.stream.write(linestr)
+            self.write(linestr)
 
         if conflicts.line_B:
-            self.stream.write(state.text_green())
-            self.stream.write(conflicts.line_B.text)
-            self.stream.write(state.text_reset())
+            self.write(state.text_green())
+            self.write(conflicts.line_B.text)
+            self.write(state.text_reset())
 
-        self.stream.write(state.text_reset())
+        self.write(state.text_reset())
         linestr = "<<<<<<\n"
 
-        self.stream.write(linestr)
+        self.write(linestr)
 
     @staticmethod
     def line_to_str(line, cursor_LCA, cursor_line):
@@ -174,8 +198,8 @@ class Diff2OutputDriver(OutputDriver):
         self.all_headers = all_headers
 
         name = os.path.basename(sys.argv[0])
-        file1 = file_LCA.reader.reader.file.stream.name
-        file2 = file_A.reader.reader.file.stream.name
+        file1 = file_LCA.reader.reader.stream.name
+        file2 = file_A.reader.reader.stream.name
 
         if file_common_name:
             file1 = "a/" + file_common_name
@@ -0,0 +1,114 @@
+#!usr/bin/python3
+
+import unittest
+import os
+import stat
+import tempfile
+import filecmp
+from unittest import mock
+from click.testing import CliRunner
+
+from csvdiff3.cli_merge3 import cli_merge3
+from csvdiff3.file import CSVKeyError
+from csvdiff3.merge3 import PrimaryKeyError
+
+def data_path(path):
+    return "testdata/" + path
+
+class TestMerge3OutputFile(unittest.TestCase):
+    """
+    Test how csvmerge3 -o writes its output file.
+    """
+
+    file_input = data_path("simple.csv")
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self.tempdir.name, "out.csv")
+
+        self.saved_umask = os.umask(0o022)
+
+    def tearDown(self):
+        os.umask(self.saved_umask)
+        self.tempdir.cleanup()
+
+    def run_merge(self, output_file, key = "name"):
+        runner = CliRunner()
+        return runner.invoke(cli_merge3,
+                             [self.file_input, self.file_input, self.file_input,
+                              "-k", key,
+                              "-o", output_file])
+
+    def mode(self, filename):
+        return stat.S_IMODE(os.stat(filename).st_mode)
+
+    def test_new_file_mode(self):
+        result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(filecmp.cmp(self.output_file, self.file_input,
+                                    shallow=False))
+        self.assertEqual(self.mode(self.output_file), 0o644)
+
+    def test_existing_file_mode(self):
+        with open(self.output_file, "wt") as file:
+            file.write("old contents\n")
+        os.chmod(self.output_file, 0o664)
+
+        result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(filecmp.cmp(self.output_file, self.file_input,
+                                    shallow=False))
+        self.assertEqual(self.mode(self.output_file), 0o664)
+
+    def test_symlink_output(self):
+        target = os.path.join(self.tempdir.name, "target.csv")
+        with open(target, "wt") as file:
+            file.write("old contents\n")
+        os.symlink("target.csv", self.output_file)
+
+        result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.islink(self.output_file))
+        self.assertTrue(filecmp.cmp(target, self.file_input, shallow=False))
+
+    def test_hard_linked_output(self):
+        # A file with other links must be written through, not
+        # replaced, so that every link sees the new contents.
+        with open(self.output_file, "wt") as file:
+            file.write("old contents\n")
+        other_link = os.path.join(self.tempdir.name, "other.csv")
+        os.link(self.output_file, other_link)
+
+        result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.samefile(self.output_file, other_link))
+        self.assertTrue(filecmp.cmp(other_link, self.file_input, shallow=False))
+
+    def test_device_output(self):
+        # Output to a device (here /dev/null, through a symlink so
+        # that a stray temporary file would show up in our directory)
+        # must be written through, leaving the device in place.
+        os.symlink(os.devnull, self.output_file)
+
+        result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(stat.S_ISCHR(os.stat(os.devnull).st_mode))
+        self.assertEqual(os.listdir(self.tempdir.name), ["out.csv"])
+
+    def test_key_error_removes_temp_file(self):
+        # merge3() checks the key before it ever gets to the point of
+        # raising CSVKeyError, so raise it directly.
+        with mock.patch("csvdiff3.cli_merge3.merge3",
+                        side_effect = CSVKeyError("bad key")):
+            result = self.run_merge(self.output_file)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Error: bad key", result.output)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_merge_failure_removes_temp_file(self):
+        result = self.run_merge(self.output_file, key = "nosuchkey")
+        self.assertIsInstance(result.exception, PrimaryKeyError)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -43,8 +43,8 @@ class TestFile(unittest.TestCase):
             with self.assertRaises(IndexError):
                 line = file[4]
 
-            self.assertEqual(file.lines_by_key["apple"], [file[2]])
-            self.assertEqual(file.lines_by_key["banana"], [file[3]])
+            self.assertEqual(list(file.lines_by_key["apple"]), [file[2]])
+            self.assertEqual(list(file.lines_by_key["banana"]), [file[3]])
 
             with self.assertRaises(KeyError):
                 lines = file.lines_by_key["plum"]
@@ -88,8 +88,8 @@ class TestFile(unittest.TestCase):
             with self.assertRaises(IndexError):
                 line = file[4]
 
-            self.assertEqual(file.lines_by_key["apple"], [file[2]])
-            self.assertEqual(file.lines_by_key["banana"], [file[3]])
+            self.assertEqual(list(file.lines_by_key["apple"]), [file[2]])
+            self.assertEqual(list(file.lines_by_key["banana"]), [file[3]])
 
             with self.assertRaises(KeyError):
                 lines = file.lines_by_key["plum"]
@@ -112,11 +112,22 @@ class TestFile(unittest.TestCase):
             self.assertEqual(line.text, "apple,3\n")
             self.assertEqual(line.row, ["apple","3"])
 
-            self.assertEqual(file.lines_by_key["apple"], [file[2], file[3]])
+            self.assertEqual(list(file.lines_by_key["apple"]), [file[2], file[3]])
 
             with self.assertRaises(KeyError):
                 lines = file.lines_by_key["banana"]
 
+    def test_header_file_read_once(self):
+        """
+        Test that the lines of a CSVHeaderFile can only be read once
+        """
+        with open(self.simple_filename, "rt") as file:
+            file = CSVHeaderFile(file)
+
+            self.assertEqual([line.text for line in file],
+                             ["apple,2\n", "banana,3\n"])
+            self.assertEqual(list(file), [])
+
     def test_badkey(self):
         """
         Test handling of a file that does not contain the key
@@ -144,8 +155,8 @@ class TestFile(unittest.TestCase):
             self.assertEqual(line.text, 'banana,"3\nand even more"\n')
             self.assertEqual(line.row, ["banana","3\nand even more"])
 
-            self.assertEqual(file.lines_by_key["apple"], [file[2]])
-            self.assertEqual(file.lines_by_key["banana"], [file[3]])
+            self.assertEqual(list(file.lines_by_key["apple"]), [file[2]])
+            self.assertEqual(list(file.lines_by_key["banana"]), [file[3]])
 
 
 class TestCursor(unittest.TestCase):
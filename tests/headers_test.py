@@ -127,6 +127,22 @@ class TestHeaders(unittest.TestCase):
                     ["A", "C", "D", "F", "G", "I", "H", "E"],
                     ["G", "A", "D", "F", "I", "H", "E"])
 
+    def test_map_all_headers(self):
+        """
+        Test the full map of added and removed columns, including
+        columns which sit at different positions in A and B.
+        """
+        headers = Headers(["name", "value", "more"],
+                          ["name", "extra", "more"],
+                          ["more", "name", "value"])
+        full_map = [(x.name, x.LCA_column, x.A_column, x.B_column)
+                    for x in headers.map_all_headers()]
+        self.assertEqual(full_map,
+                         [("more", 2, 2, 0),
+                          ("name", 0, 0, 1),
+                          ("value", 1, None, 2),
+                          ("extra", None, 1, None)])
+
 
 if __name__ == "__main__":
     unittest.main()
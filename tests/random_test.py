@@ -106,31 +106,6 @@ class RandomFile:
         except StopIteration:
             return ""
 
-    def read(self, length):
-        """
-        Also provide a buffered read() function to allow the csvmerge
-        dump-on-failure handler to run shutil.copyfileobj() on the
-        RandomFile
-        """
-        buffer = getattr(self, "buffer", None)
-        if not buffer:
-            # Fetch a new line if we don't already have any content
-            buffer = self.readline()
-        buflen = len(buffer)
-
-        if buflen:
-            # Return as much of the current line as will fit into the request
-            retlen = max(buflen, length)
-            result = buffer[:retlen]
-            buffer = buffer[retlen:]
-        else:
-            # At EOF we just return nothing.
-            result = ''
-            buffer = None
-
-        self.buffer = buffer
-        return result
-
     def seek(self, offset, whence = 0):
         """Seek to a new file offset"""
 